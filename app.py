@@ -1,71 +1,396 @@
-import base64
+import hashlib
+import json
 import logging
+import random
+import re
+import threading
 import uuid
-import requests
 import boto3
-import toml
 import streamlit as st
 import time
-from PIL import Image
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from PIL import Image, ImageOps
 from io import BytesIO
+from urllib.parse import unquote_plus, urlparse
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 
 # Load credentials
-# credential = toml.load("credential.toml")
-# credential = credential["aws"]
 aws_access_key_id = st.secrets["AWS_ACCESS_KEY_ID"]
 aws_secret_access_key = st.secrets["AWS_SECRET_ACCESS_KEY"]
+# Optional bucket region; setting it saves botocore looking it up on the first request
+aws_region = st.secrets.get("AWS_REGION")
+# Optional SQS queue receiving s3:ObjectCreated:* events for the image/labelled/ prefix
+sqs_queue_url = st.secrets.get("SQS_QUEUE_URL")
 
-# Initialize S3 client
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=aws_access_key_id,
-    aws_secret_access_key=aws_secret_access_key
-)
+BUCKET_NAME = 'test-sakaeriken-img-recognition'
 
-def generate(image_data):
-    image_key = f'image/unlabelled/{uuid.uuid4()}.jpg'
+def warm_up_s3_client(client):
     try:
-        response = s3_client.generate_presigned_post(Bucket='test-sakaeriken-img-recognition', Key=image_key, ExpiresIn=3600)
+        client.head_bucket(Bucket=BUCKET_NAME)
+    except (BotoCoreError, ClientError) as e:
+        logging.warning(f"S3 client warm-up failed: {e}")
+
+# Initialize S3 client once per process so its connection pool survives reruns
+@st.cache_resource
+def get_s3_client():
+    client = boto3.client(
+        's3',
+        aws_access_key_id=aws_access_key_id,
+        aws_secret_access_key=aws_secret_access_key,
+        config=Config(
+            region_name=aws_region,
+            retries={'mode': 'adaptive', 'max_attempts': 5},
+            connect_timeout=5,
+            read_timeout=30,
+            tcp_keepalive=True,
+            # The client is shared by every session in the process
+            max_pool_connections=32,
+            # Skip the default CRC32 over every upload/download body; TLS already
+            # protects the transfer
+            request_checksum_calculation='when_required',
+            response_checksum_validation='when_required'
+        )
+    )
+    # Open the pool's first connection and learn the bucket region on the client the
+    # app actually uses; done in the background so the first page load never waits on it
+    threading.Thread(target=warm_up_s3_client, args=(client,), name='s3-warm-up', daemon=True).start()
+    return client
+
+s3_client = get_s3_client()
+
+def sqs_queue_region(queue_url):
+    host = urlparse(queue_url).hostname or ''
+    # Queue URLs look like https://sqs.<region>.amazonaws.com/<account>/<name>
+    match = re.match(r'sqs\.([a-z0-9-]+)\.amazonaws\.com', host)
+    if match:
+        return match.group(1)
+    # Legacy https://queue.amazonaws.com/<account>/<name> URLs are us-east-1 queues
+    if host == 'queue.amazonaws.com':
+        return 'us-east-1'
+    return aws_region
+
+# Image validation limits
+MAX_IMAGE_SIZE = 10 * 1024 * 1024
+MAX_IMAGE_DIMENSION = 10000
+# Many phone cameras write MPO files: a JPEG with extra images appended
+ALLOWED_IMAGE_FORMATS = ('JPEG', 'MPO', 'PNG')
+JPEG_SIGNATURE = b'\xff\xd8\xff'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def validate_image(image_data):
+    # Reject anything that isn't a JPEG or PNG before handing it to Pillow
+    if not (image_data.startswith(JPEG_SIGNATURE) or image_data.startswith(PNG_SIGNATURE)):
+        return False, "Unsupported image format", None
+    if len(image_data) > MAX_IMAGE_SIZE:
+        return False, f"Image is larger than {MAX_IMAGE_SIZE // (1024 * 1024)}MB", None
+    try:
+        # Image.open only parses the header; pixel data isn't decoded here
+        image = Image.open(BytesIO(image_data))
+    except Exception as e:
+        return False, f"Invalid image file: {e}", None
+    if image.format not in ALLOWED_IMAGE_FORMATS:
+        return False, f"Unsupported image format: {image.format}", None
+    if max(image.size) > MAX_IMAGE_DIMENSION:
+        return False, f"Image dimensions {image.width}x{image.height} are too large", None
+    return True, "Image is valid", image
+
+# Largest side sent for detection; bigger pictures are downscaled before upload
+MAX_UPLOAD_DIMENSION = 1280
+
+def downscale_image(image, image_data):
+    # image is the still-undecoded Image from validate_image, so the bytes are
+    # only parsed once and only decoded when they actually need resizing or,
+    # for PNGs, re-encoding to match the .jpg key and image/jpeg ContentType
+    if max(image.size) <= MAX_UPLOAD_DIMENSION and image.format in ('JPEG', 'MPO'):
+        return image_data
+    # thumbnail() lets JPEG decode straight at reduced scale
+    image.thumbnail((MAX_UPLOAD_DIMENSION, MAX_UPLOAD_DIMENSION), Image.LANCZOS)
+    # The EXIF orientation tag is lost on re-encode, so apply it to the pixels
+    image = ImageOps.exif_transpose(image)
+    if 'A' in image.getbands() or 'transparency' in image.info:
+        # Flatten transparent pixels onto white; convert('RGB') alone turns them black
+        background = Image.new('RGBA', image.size, 'white')
+        image = Image.alpha_composite(background, image.convert('RGBA'))
+    image = image.convert('RGB')
+    with BytesIO() as buffer:
+        image.save(buffer, 'JPEG', quality=85, optimize=True, progressive=True)
+        return buffer.getvalue()
+
+def upload_to_s3(image_data, image_key):
+    try:
+        # Retries with backoff are handled by the client's adaptive retry mode
+        s3_client.put_object(Bucket=BUCKET_NAME, Key=image_key, Body=image_data, ContentType='image/jpeg')
+    except (BotoCoreError, ClientError) as e:
+        logging.error(f"Uploading {image_key} failed: {e}")
+        return f"Image Uploading Unsuccessful, error: {e}"
+    return "Image uploaded successfully!"
+
+# Labelled image polling settings: the delay between HEAD checks doubles from
+# MIN_POLLING_INTERVAL up to MAX_POLLING_INTERVAL, giving up after POLLING_TIMEOUT seconds
+MIN_POLLING_INTERVAL = 0.5
+MAX_POLLING_INTERVAL = 4.0
+POLLING_TIMEOUT = 30
+
+def parse_s3_event(body):
+    # Returns the object keys in an S3 event notification, [] for an s3:TestEvent,
+    # or None for a message that isn't an S3 event at all
+    event = json.loads(body)
+    # SNS wraps the S3 event in an envelope unless raw message delivery is enabled
+    if event.get('Type') == 'Notification':
+        event = json.loads(event['Message'])
+    if event.get('Event') == 's3:TestEvent':
+        return []
+    if 'Records' not in event:
+        return None
+    return [unquote_plus(record['s3']['object']['key']) for record in event['Records']]
+
+# How long arrived keys are remembered for sessions that haven't started waiting yet
+EVENT_RETENTION = 2 * POLLING_TIMEOUT
+
+class LabelledEventListener:
+    # One background consumer per process reads the S3 event queue, deletes what it
+    # reads and records which labelled keys have arrived. Sessions wait on that
+    # record instead of receiving (and re-driving) each other's messages.
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+        self.sqs_client = boto3.client(
+            'sqs',
+            region_name=sqs_queue_region(queue_url),
+            aws_access_key_id=aws_access_key_id,
+            aws_secret_access_key=aws_secret_access_key,
+            config=Config(retries={'mode': 'adaptive', 'max_attempts': 5}, tcp_keepalive=True)
+        )
+        self.condition = threading.Condition()
+        self.arrived = {}
+        self.failed = False
+        self.stopped = threading.Event()
+        threading.Thread(target=self.run, name='labelled-event-listener', daemon=True).start()
+
+    def stop(self):
+        # Called when the cache entry is released (e.g. "Clear cache"), so the
+        # replacement listener is the only consumer deleting events
+        self.stopped.set()
+        with self.condition:
+            # Sessions still waiting on this listener fall back to HEAD polling
+            self.failed = True
+            self.condition.notify_all()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                response = self.sqs_client.receive_message(QueueUrl=self.queue_url, WaitTimeSeconds=20, MaxNumberOfMessages=10)
+            except (BotoCoreError, ClientError) as e:
+                logging.warning(f"Receiving S3 events from SQS failed, sessions fall back to polling: {e}")
+                with self.condition:
+                    self.failed = True
+                    self.condition.notify_all()
+                self.stopped.wait(MAX_POLLING_INTERVAL)
+                continue
+            if self.stopped.is_set():
+                # Leave this batch on the queue for the replacement listener
+                break
+
+            arrived_keys = []
+            for message in response.get('Messages', []):
+                try:
+                    keys = parse_s3_event(message['Body'])
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    # Nothing can ever read it, so drop it rather than see it again
+                    # after every visibility timeout
+                    logging.warning(f"Deleting unreadable SQS message {message.get('MessageId')}: {e}")
+                    keys = []
+                if keys is None:
+                    continue
+                arrived_keys.extend(keys)
+                try:
+                    # Every S3 event is recorded below, so nobody else needs the message
+                    self.sqs_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message['ReceiptHandle'])
+                except (BotoCoreError, ClientError) as e:
+                    logging.warning(f"Deleting SQS message {message.get('MessageId')} failed: {e}")
+
+            now = time.monotonic()
+            with self.condition:
+                self.failed = False
+                self.arrived.update(dict.fromkeys(arrived_keys, now))
+                for key, arrived_at in list(self.arrived.items()):
+                    if now - arrived_at > EVENT_RETENTION:
+                        del self.arrived[key]
+                self.condition.notify_all()
+
+    def wait(self, labelled_image_key, deadline):
+        # True once the key's event has arrived; False on timeout or while SQS is failing
+        with self.condition:
+            self.condition.wait_for(
+                lambda: labelled_image_key in self.arrived or self.failed,
+                timeout=max(0, deadline - time.monotonic())
+            )
+            return self.arrived.pop(labelled_image_key, None) is not None
+
+@st.cache_resource(on_release=lambda listener: listener.stop())
+def get_event_listener():
+    return LabelledEventListener(sqs_queue_url)
+
+# Created from the script thread, like s3_client, so detection workers never touch the cache
+event_listener = get_event_listener() if sqs_queue_url else None
+
+def poll_for_result(labelled_image_key):
+    deadline = time.monotonic() + POLLING_TIMEOUT
+    attempt = 0
+    while True:
+        try:
+            s3_client.head_object(Bucket=BUCKET_NAME, Key=labelled_image_key)
+            break
+        except ClientError as e:
+            # A missing object only means the detection hasn't finished yet; anything
+            # else (AccessDenied, NoSuchBucket, ...) won't fix itself by waiting
+            code = e.response['Error']['Code']
+            if code not in ('404', 'NoSuchKey'):
+                logging.error(f"Polling {labelled_image_key} failed with S3 error {code}")
+                return None, f"S3 error: {code}, error: {e}"
+        except BotoCoreError as e:
+            logging.error(f"Polling {labelled_image_key} failed: {e}")
+            return None, f"Error reading image file from S3, error: {e}"
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logging.error(f"No labelled image at {labelled_image_key} after {POLLING_TIMEOUT} seconds")
+            return None, f"Screws detection timed out, no result after {POLLING_TIMEOUT} seconds"
+        if event_listener is not None and not event_listener.failed:
+            # The S3 event normally ends the wait; a HEAD check every slice still finds
+            # results whose event never arrives (notification missing, event dropped)
+            delay = MAX_POLLING_INTERVAL
+        else:
+            delay = min(MAX_POLLING_INTERVAL, MIN_POLLING_INTERVAL * (2 ** attempt)) + random.uniform(0, 0.25)
+        slice_end = time.monotonic() + min(delay, remaining)
+        if event_listener is not None and event_listener.wait(labelled_image_key, slice_end):
+            break
+        # Sleep out the rest of the slice when there's no listener, or when it gave up
+        # early because SQS is failing
+        time.sleep(max(0, slice_end - time.monotonic()))
+        attempt += 1
+
+    try:
+        # The object exists now, so the body is downloaded exactly once
+        content_object = s3_client.get_object(Bucket=BUCKET_NAME, Key=labelled_image_key)
+        # Keep the JPEG bytes as-is; st.image serves them without decoding or re-encoding
+        image = content_object['Body'].read()
+    except (BotoCoreError, ClientError) as e:
+        logging.error(f"Reading {labelled_image_key} failed: {e}")
+        return None, f"Error reading image file from S3, error: {e}"
+    return image, "Image retrieved successfully!"
+
+class DetectionError(Exception):
+    pass
+
+def detect_screws(image_data):
+    # Runs on a worker thread, so no Streamlit calls here; failures are raised as
+    # DetectionError and rendered by generate() on the script thread
+    valid, message, source_image = validate_image(image_data)
+    if not valid:
+        raise DetectionError(f"Image Validation Unsuccessful, {message}")
+    try:
+        # Only the header was checked so far; a truncated or corrupt file fails here
+        upload_data = downscale_image(source_image, image_data)
     except Exception as e:
-        st.error("Presigned URL generation unsuccessful")
-        st.error(f"Error: {e}")
-        return "Presigned URL generation unsuccessful"
-
-    files = {'file': image_data}  
-    r = requests.post(response['url'], data=response['fields'], files=files)
-    if r.status_code == 204:
-        logging.info(f"Image code: {image_key}")
-        
+        raise DetectionError(f"Image Validation Unsuccessful, Invalid image file: {e}")
+
+    unique_identifier = uuid.uuid4().hex
+    image_key = f'image/unlabelled/{unique_identifier}.jpg'
+    result = upload_to_s3(upload_data, image_key)
+    if result != "Image uploaded successfully!":
+        raise DetectionError(result)
+    logging.info(f"Image code: {image_key}")
+
+    labelled_image_key = f'image/labelled/{unique_identifier}.jpg'
+    image, result = poll_for_result(labelled_image_key)
+    if image is None:
+        raise DetectionError(result)
+    return image
+
+def run_detection(image_data):
+    try:
+        return detect_screws(image_data), "Image retrieved successfully!"
+    except DetectionError as e:
+        return None, str(e)
+
+class DetectionCache:
+    # Successful detections keyed on the picture's hash, shared by every session so
+    # reruns and repeat uploads skip S3 entirely. Failures are never stored.
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, image_hash):
+        with self.lock:
+            entry = self.entries.get(image_hash)
+            if entry is None:
+                return None
+            stored_at, image = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self.entries[image_hash]
+                return None
+            self.entries.move_to_end(image_hash)
+            return image
+
+    def put(self, image_hash, image):
+        with self.lock:
+            self.entries[image_hash] = (time.monotonic(), image)
+            self.entries.move_to_end(image_hash)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+@st.cache_resource
+def get_detection_cache():
+    return DetectionCache(ttl=3600, max_entries=64)
+
+# Most pictures run through detection at the same time when several are uploaded
+MAX_CONCURRENT_DETECTIONS = 8
+
+def generate(images):
+    detection_cache = get_detection_cache()
+    image_hashes = [hashlib.blake2b(image_data, digest_size=16).hexdigest() for image_data in images]
+    detections = {image_hash: (detection_cache.get(image_hash), "Image retrieved successfully!") for image_hash in image_hashes}
+    # Keyed by hash, so a picture uploaded twice in one batch is detected once
+    pending = {image_hash: image_data for image_hash, image_data in zip(image_hashes, images) if detections[image_hash][0] is None}
+
+    if pending:
+        # The S3 client is thread-safe, so each picture's upload and wait can overlap
         with st.spinner('Screws Detection Process Is In Progress...'):
-            time.sleep(20)
-            unique_identifier = image_key.split('/')[-1].split('.')[0]
-            labelled_image_key = f'image/labelled/{unique_identifier}.jpg'
+            with ThreadPoolExecutor(max_workers=min(len(pending), MAX_CONCURRENT_DETECTIONS)) as executor:
+                for image_hash, detection in zip(pending, executor.map(run_detection, pending.values())):
+                    detections[image_hash] = detection
+                    if detection[0] is not None:
+                        detection_cache.put(image_hash, detection[0])
+    results = [detections[image_hash] for image_hash in image_hashes]
+
+    # Everything is rendered here on the script thread, in upload order
+    if any(image is not None for image, _ in results):
         st.success("Result:")
-        try:
-            content_object = s3_client.get_object(Bucket='test-sakaeriken-img-recognition', Key=labelled_image_key)
-            file_content = content_object['Body'].read()
-            image = Image.open(BytesIO(file_content))
-            st.image(image, caption='Predicted Image', use_container_width=True)
-            return "Image retrieved successfully!"
-
-        except Exception as e:
-            st.error("Error reading image file from S3")
-            st.write(labelled_image_key)
-            st.error(f"Error: {e}")
-            return "Error reading image file from S3"
-    else:
-        st.error("Image Uploading Unsuccessful")
-        st.error(f"Failed with status code: {r.status_code}")
-        return f"Image Uploading Unsuccessful, failed with status code: {r.status_code}"
+    for number, (image, result) in enumerate(results, start=1):
+        label = f"Picture {number}: " if len(results) > 1 else ""
+        if image is not None:
+            st.image(image, caption=f'{label}Predicted Image', use_container_width=True)
+        else:
+            st.error(f"{label}{result}")
+    return [result for _, result in results]
+
+@st.cache_data
+def load_asset(path):
+    with open(path, 'rb') as f:
+        return f.read()
 
 def main():
     st.title("Automotive Manufacturing Automated Quality Inspection Prototype")
     intro_empty = st.empty()
     intro_empty.subheader("Trained on car bumper screws dataset, upload a picture to detect white and green screws")
-    st.sidebar.image("assets/logo.png")
+    st.sidebar.image(load_asset("assets/logo.png"))
     st.sidebar.title("Automated Quality Inspection")
     option = st.sidebar.selectbox("Choose image to be inspected:", (None, "Take a picture", "Upload a picture"))
 
@@ -76,20 +401,24 @@ def main():
             # Convert to bytes for uploading
             picture_bytes = picture.getvalue()
             intro_empty.empty()
-            result = generate(picture_bytes)
-            if result == "Image retrieved successfully!":
-                logging.info(result)
+            results = generate([picture_bytes])
+            for result in results:
+                if result == "Image retrieved successfully!":
+                    logging.info(result)
     
     elif option == "Upload a picture":
-        image = st.sidebar.file_uploader("Upload a picture", type=["jpg", "jpeg", "png"])
-        if image is not None:
-            st.sidebar.image(image, caption='Uploaded Image', use_container_width=True)
+        images = st.sidebar.file_uploader("Upload pictures", type=["jpg", "jpeg", "png"], accept_multiple_files=True)
+        if images:
+            for number, image in enumerate(images, start=1):
+                caption = f'Picture {number}' if len(images) > 1 else 'Uploaded Image'
+                st.sidebar.image(image, caption=caption, use_container_width=True)
             # Convert to bytes for uploading
-            image_bytes = image.getvalue()
+            images_bytes = [image.getvalue() for image in images]
             intro_empty.empty()
-            result = generate(image_bytes)
-            if result == "Image retrieved successfully!":
-                logging.info(result)
+            results = generate(images_bytes)
+            for result in results:
+                if result == "Image retrieved successfully!":
+                    logging.info(result)
 
 if __name__ == "__main__":
     main()